@@ -2,6 +2,9 @@
 #!/usr/bin/env python3
 # scripts/scan_and_report.py
 
+import atexit
+import csv
+import json
 import os
 import sys
 import smtplib
@@ -9,8 +12,8 @@ import ssl
 import subprocess
 from datetime import datetime
 from email.mime.text import MIMEText
+from collections import namedtuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from pathlib import Path
 import tempfile
 import shutil
 
@@ -33,7 +36,17 @@ TIMEZONE        = os.getenv("TIMEZONE", "").strip()
 FROM            = os.getenv("FROM", "").strip()
 TO              = os.getenv("TO", "").strip()
 
-# ディレクトリを渡す場合にのみ使用（今回のファイル単位方式では基本未使用）
+# ホスト単位の並列数（未設定なら CPU コア数）
+SCAN_WORKERS    = os.getenv("SCAN_WORKERS", "").strip()
+
+# true なら全ホストを 1 回の chainsaw 実行にまとめ、出力の path 列でホストに振り分ける
+# （Sigma ルールのコンパイルがスキャン全体で 1 回になる。csv/json 形式のみ対応）
+BATCH_ALL_HOSTS = os.getenv("BATCH_ALL_HOSTS", "false").strip().lower() == "true"
+
+# true なら SIGMA_DIR を /dev/shm に一度コピーして使う（低速ストレージ／コールドキャッシュ向け）
+SIGMA_SHM       = os.getenv("SIGMA_SHM", "false").strip().lower() == "true"
+
+# 対象ファイルの拡張子（chainsaw の --extension とスクリプト側の列挙の両方に使う）
 EXTENSIONS      = [ext.strip() for ext in os.getenv("EXTENSIONS", ".evtx").split(",") if ext.strip()]
 
 SMTP_HOST       = os.getenv("SMTP_HOST", "").strip()
@@ -64,19 +77,24 @@ if not MAPPING_YML or not os.path.isfile(MAPPING_YML):
 
 os.makedirs(REPORTS_DIR, exist_ok=True)
 
-# ====== Chainsaw コマンド組み立て（ファイル単位） ======
-def build_hunt_cmd_for_file(evtx_file: str, output_dir: str, rules_dir: str, force_non_quiet: bool = False):
+# 拡張子判定用（.evtx / .EVTX / .Evtx）。ファイルごとに lower() した文字列を作らないよう事前に展開
+_EXT_TUPLE = tuple(dict.fromkeys(
+    v
+    for ext in EXTENSIONS
+    for e in [ext if ext.startswith(".") else f".{ext}"]
+    for v in (e, e.lower(), e.upper(), "." + e[1:].capitalize())
+))
+if not _EXT_TUPLE:
+    # EXTENSIONS が空なら従来どおり .evtx を対象にする（何も走査されないのを防ぐ）
+    _EXT_TUPLE = (".evtx", ".EVTX", ".Evtx")
+
+# ====== Chainsaw コマンド組み立て（ホスト単位でまとめて実行） ======
+def _build_cmd_prefix() -> tuple[str, ...]:
     """
-    あなたの chainsaw ビルド仕様:
-      Usage: chainsaw hunt --mapping <MAPPING> --output <OUTPUT> --sigma <SIGMA> --csv --local <RULES> [PATH]...
-
-    必須:
-      --mapping, --output, --sigma, 出力形式(--csv/--json/--log), --local, <RULES>, [PATH...]
+    環境変数だけで決まる不変部分（起動時に 1 回だけ組み立てる）。
     """
     cmd = ["chainsaw", "hunt",
-           "--mapping", MAPPING_YML,
-           "--output", output_dir,
-           "--sigma", SIGMA_DIR]
+           "--mapping", MAPPING_YML]
 
     # 出力形式
     if CHAINS_FORMAT == "csv":
@@ -98,33 +116,150 @@ def build_hunt_cmd_for_file(evtx_file: str, output_dir: str, rules_dir: str, for
     elif TIMEZONE:
         cmd.extend(["--timezone", TIMEZONE])
 
-    # Chainsaw ネイティブルール（ヘルプにより必須とみなす）
-    # 未設定なら空ディレクトリを指す
-    cmd.extend(["-r", rules_dir])
-
     # 期間
     if FROM:
         cmd.extend(["--from", FROM])
     if TO:
         cmd.extend(["--to", TO])
 
+    # 対象拡張子（PATH にディレクトリを渡すため chainsaw 側で絞り込む）
+    # chainsaw はドット無し・大文字小文字を区別して比較するので _EXT_TUPLE の表記揺れをそのまま渡す
+    for e in _EXT_TUPLE:
+        cmd.extend(["--extension", e[1:]])
+
+    # 読めないファイルがあっても中断せず残りを処理する（1 ファイルの破損でホスト全体の検出を失わないため）
+    cmd.append("--skip-errors")
+
+    return tuple(cmd)
+
+
+_CMD_PREFIX = _build_cmd_prefix()
+
+
+def build_hunt_cmd(paths: list[str], output_dir: str, rules_dir: str, sigma_dir: str, force_non_quiet: bool = False):
+    """
+    あなたの chainsaw ビルド仕様:
+      Usage: chainsaw hunt --mapping <MAPPING> --output <OUTPUT> --sigma <SIGMA> --csv --local <RULES> [PATH]...
+
+    必須:
+      --mapping, --output, --sigma, 出力形式(--csv/--json/--log), --local, <RULES>, [PATH...]
+
+    不変部分は _CMD_PREFIX を使い、実行ごとに変わる部分だけを後ろに付け足す。
+    Chainsaw ネイティブルール（-r、ヘルプにより必須とみなす）は未設定なら空ディレクトリを指す。
+    """
+    cmd = [*_CMD_PREFIX,
+           "--sigma", sigma_dir,
+           "--output", output_dir,
+           "-r", rules_dir]
+
     # quiet 制御
-    effective_quiet = (QUIET and not force_non_quiet)
-    if effective_quiet:
+    if QUIET and not force_non_quiet:
         cmd.append("-q")
 
-    # 最後に対象ファイル
-    cmd.append(evtx_file)
+    # 最後に対象パス。ファイルを列挙して渡すとファイル数次第で ARG_MAX（E2BIG）を超えるため、
+    # ディレクトリを渡して chainsaw 側で再帰列挙させる（[PATH]... は複数指定可）
+    cmd.extend(paths)
 
     return cmd
 
 
-def run_for_host(host_dir: str):
+# ====== 検出判定ヘルパ ======
+def _csv_has_rows(path: str) -> bool:
+    """
+    CSV にヘッダー＋1行以上（空行除く）があるか。
+    ファイル全体を読まず、2 行目の非空行が見つかった時点で打ち切る。
+    """
+    count = 0
+    with open(path, "r", encoding="utf-8", errors="ignore", buffering=1 << 16) as fh:
+        for line in fh:
+            if line.strip():
+                count += 1
+                if count >= 2:
+                    return True
+    return False
+
+
+def _json_has_content(path: str) -> bool:
+    """
+    JSON レポートが空（空ファイル / [] / {}）でないか。先頭 512 バイトだけ読んで判定する。
+    """
+    with open(path, "rb") as fh:
+        head = b"".join(fh.read(512).split())  # 空白・改行を除去
+    return bool(head) and head not in (b"[]", b"{}")
+
+
+def _detect(out_dir: str, log_path: str | None) -> tuple[bool, str | None]:
     """
-    ホストディレクトリ配下の .evtx をすべて再帰列挙し、
-    ファイル単位で chainsaw hunt を実行。chainsaw の --output に同一 out_dir を指定して集約。
+    CHAINS_FORMAT に応じて検出有無を判定し、(検出有無, レポートパス) を返す。
+      csv : out_dir 内の CSV のうち、ヘッダー＋1行以上があるファイルがあれば検出あり
+      json: out_dir 内の JSON が非空なら検出あり
+      log : 自前ログ（log_path）から簡易判定（log_path が None なら判定しない）
+    """
+    if CHAINS_FORMAT in ("csv", "json"):
+        ext = f".{CHAINS_FORMAT}"
+        with os.scandir(out_dir) as it:
+            for entry in it:
+                if not (entry.name.endswith(ext) and entry.is_file()):
+                    continue
+                try:
+                    if ext == ".csv":
+                        has_rows = _csv_has_rows(entry.path)
+                    else:
+                        has_rows = _json_has_content(entry.path)
+                    if has_rows:
+                        return True, entry.path
+                except Exception:
+                    pass
+        return False, None
+
+    if log_path is None:
+        return False, None
+    try:
+        with open(log_path, "r", encoding="utf-8", errors="ignore", buffering=1 << 16) as fh:
+            for line in fh:
+                if "DETECTED" in line or "Matches:" in line:
+                    return True, None
+        return False, None
+    except Exception:
+        return False, None
+
+
+def _iter_targets(host_dir: str):
+    """
+    EXTENSIONS（既定 .evtx）のファイルを再帰列挙（大文字・小文字・先頭大文字に対応）。
+    resolve() は全祖先を stat するので使わない。
+    """
+    for root, _, files in os.walk(host_dir):
+        for fn in files:
+            if fn.endswith(_EXT_TUPLE):
+                yield os.path.join(root, fn)
+
+
+def _has_targets(host_dir: str) -> bool:
+    """
+    対象ファイルが 1 件でもあるか（最初の 1 件で走査を打ち切る）。
+    """
+    return next(_iter_targets(host_dir), None) is not None
+
+
+# ホスト単位の実行結果（ログパス等は保持しない）
+Result = namedtuple("Result", ["host", "report_path", "detected"])
+
+
+def run_for_host(host_dir: str, rules_dir: str, sigma_dir: str):
+    """
+    対象ファイルが無ければ何もせず SKIP、あれば
+    ホストディレクトリを PATH として 1 回の chainsaw hunt で処理し、結果を out_dir に集約。
     """
     host = os.path.basename(host_dir.rstrip("/"))
+
+    # 対象が無ければレポートディレクトリも作らず、chainsaw も起動せずに終了
+    # 非 QUIET はヘッダに全件書くので全列挙、QUIET は 1 件見つかった時点で走査を打ち切る
+    target_files = None if QUIET else list(_iter_targets(host_dir))
+    if not (_has_targets(host_dir) if QUIET else target_files):
+        print(f"[SKIP] {host}: no target files")
+        return Result(host, None, False)
+
     ts = datetime.now().strftime("%Y%m%d%H%M%S")
 
     # 出力ディレクトリ（chainsaw --output はディレクトリ必須）
@@ -132,148 +267,182 @@ def run_for_host(host_dir: str):
     os.makedirs(out_dir, exist_ok=True)
     log_path = os.path.join(out_dir, f"{host}-{ts}.log")
 
-    # .evtx を再帰列挙（大小文字対応）
-    evtx_files = [str(p.resolve()) for p in Path(host_dir).rglob("*")
-                  if p.is_file() and p.suffix.lower() == ".evtx"]
-
-    # RULES_DIR（Chainsaw独自ルール）必須対応：設定が無ければ空ディレクトリを用意
-    rules_dir = CHAINS_RULE_DIR
-    temp_rules_dir = None
-    if not rules_dir:
-        temp_rules_dir = tempfile.mkdtemp(prefix="chainsaw_rules_")
-        rules_dir = temp_rules_dir  # 空でOK（SigmaのみでもCLI要件を満たすため）
-
     try:
         if not QUIET:
             # === ログファイル出力（STDOUT/STDERRを結合） ===
-            with open(log_path, "w", encoding="utf-8", newline="") as lf:
-                # 実行条件ヘッダ
-                lf.write(f"# started: {datetime.now().isoformat()}\n")
-                lf.write(f"# host_dir: {host_dir}\n")
-                lf.write(f"# levels: {','.join(CHAINS_LEVELS) if CHAINS_LEVELS else 'ALL'}\n")
-                lf.write(f"# mode: {CHAINS_MODE}, format: {CHAINS_FORMAT}\n")
-                lf.write(f"# output_dir: {out_dir}\n")
-                lf.write(f"# rules_dir: {rules_dir}\n")
-                lf.write("# target files:\n")
-                if evtx_files:
-                    for f in evtx_files:
-                        lf.write(f"#   {f}\n")
-                else:
-                    lf.write("#   (none found)\n")
-                lf.write(f"# target count: {len(evtx_files)}\n\n")
+            # 実行条件ヘッダ（非バッファのバイナリ書き込みなので 1 回にまとめて書く）
+            header = [
+                f"# started: {datetime.now().isoformat()}\n",
+                f"# host_dir: {host_dir}\n",
+                f"# levels: {','.join(CHAINS_LEVELS) if CHAINS_LEVELS else 'ALL'}\n",
+                f"# mode: {CHAINS_MODE}, format: {CHAINS_FORMAT}\n",
+                f"# output_dir: {out_dir}\n",
+                f"# rules_dir: {rules_dir}\n",
+                f"# sigma_dir: {sigma_dir}\n",
+                "# target files:\n",
+            ]
+            header.extend(f"#   {f}\n" for f in target_files)
+            header.append(f"# target count: {len(target_files)}\n\n")
+
+            # === ホストディレクトリを 1 回の Chainsaw 実行で処理し、out_dir に集約 ===
+            cmd = build_hunt_cmd([host_dir], output_dir=out_dir, rules_dir=rules_dir, sigma_dir=sigma_dir, force_non_quiet=True)
+            header.append(f"# cmd: {' '.join(cmd)}\n")
+
+            # chainsaw の STDOUT/STDERR は fd ごとログファイルへ直接渡す（親プロセスでは読まない）
+            with open(log_path, "wb", buffering=0) as lf:
+                lf.write("".join(header).encode("utf-8"))
+                returncode = subprocess.run(cmd, stdout=lf, stderr=lf, check=False).returncode
 
-                if not evtx_files:
-                    lf.write("# skipped: no .evtx found\n")
-                else:
-                    # === ファイル単位で Chainsaw を実行し、同一 out_dir に集約 ===
-                    for f in evtx_files:
-                        cmd = build_hunt_cmd_for_file(f, output_dir=out_dir, rules_dir=rules_dir, force_non_quiet=True)
-                        lf.write(f"# cmd: {' '.join(cmd)}\n")
-                        subprocess.run(cmd, stdout=lf, stderr=lf, text=True, check=False)
-
-            # === 検出判定 ===
-            detected = False
-            report_path = None
-
-            if CHAINS_FORMAT == "csv":
-                # out_dir 内の CSV のうち、ヘッダー＋1行以上があるファイルがあれば検出あり
-                for cf in sorted(Path(out_dir).glob("*.csv")):
-                    try:
-                        text = Path(cf).read_text(encoding="utf-8", errors="ignore")
-                        rows = [ln for ln in text.splitlines() if ln.strip()]
-                        if len(rows) > 1:
-                            detected = True
-                            report_path = str(cf)
-                            break
-                    except Exception:
-                        pass
-            elif CHAINS_FORMAT == "json":
-                for jf in sorted(Path(out_dir).glob("*.json")):
-                    try:
-                        if Path(jf).read_text(encoding="utf-8", errors="ignore").strip():
-                            detected = True
-                            report_path = str(jf)
-                            break
-                    except Exception:
-                        pass
-            else:
-                # log 形式の場合は自前ログから簡易判定
-                try:
-                    content = Path(log_path).read_text(encoding="utf-8", errors="ignore")
-                    detected = ("DETECTED" in content) or ("Matches:" in content)
-                except Exception:
-                    detected = False
+        else:
+            # === QUIET=true：標準出力のみ（ただし --output が必須なので out_dir には出る）。ここでは判定のみ ===
+            # 実行（コマンド出力は読まずに捨てる）
+            cmd = build_hunt_cmd([host_dir], output_dir=out_dir, rules_dir=rules_dir, sigma_dir=sigma_dir, force_non_quiet=False)
+            returncode = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False).returncode
 
-            status = "DETECTED" if detected else "CLEAN"
-            print(f"[{status}] {host} -> {report_path or '(no report file)'} (log: {log_path})")
+        if returncode != 0:
+            # 異常終了時はレポートが不完全なので「検出なし」とは扱わない
+            log_note = "" if QUIET else f", log: {log_path}"
+            print(f"[ERROR] {host}: chainsaw が異常終了しました (exit {returncode}{log_note})", file=sys.stderr)
+            return Result(host, None, False)
 
-            return {
-                "host": host,
-                "report_path": report_path,
-                "log_path": log_path,
-                "detected": detected,
-            }
+        # === 検出判定（QUIET 時は自前ログが無いので log 形式は判定しない） ===
+        detected, report_path = _detect(out_dir, log_path if not QUIET else None)
 
-        else:
-            # === QUIET=true：標準出力のみ（ただし --output が必須なので out_dir には出る）。ここでは判定のみ ===
-            detected = False
-            report_path = None
-
-            # 実行（コマンド出力は抑制）
-            if evtx_files:
-                for f in evtx_files:
-                    cmd = build_hunt_cmd_for_file(f, output_dir=out_dir, rules_dir=rules_dir, force_non_quiet=False)
-                    subprocess.run(cmd, capture_output=True, text=True, check=False)
-
-            # 判定ロジックは上と同じ
-            if CHAINS_FORMAT == "csv":
-                for cf in sorted(Path(out_dir).glob("*.csv")):
-                    try:
-                        text = Path(cf).read_text(encoding="utf-8", errors="ignore")
-                        rows = [ln for ln in text.splitlines() if ln.strip()]
-                        if len(rows) > 1:
-                            detected = True
-                            report_path = str(cf)
-                            break
-                    except Exception:
-                        pass
-            elif CHAINS_FORMAT == "json":
-                for jf in sorted(Path(out_dir).glob("*.json")):
-                    try:
-                        if Path(jf).read_text(encoding="utf-8", errors="ignore").strip():
-                            detected = True
-                            report_path = str(jf)
-                            break
-                    except Exception:
-                        pass
-            else:
-                detected = False
-                report_path = None
-
-            status = "DETECTED" if detected else "CLEAN"
+        status = "DETECTED" if detected else "CLEAN"
+        if QUIET:
             print(f"[{status}] {host} -> {report_path or '(no report file)'}")
-            return {
-                "host": host,
-                "report_path": report_path,
-                "log_path": None if QUIET else log_path,
-                "detected": detected,
-            }
+        else:
+            print(f"[{status}] {host} -> {report_path or '(no report file)'} (log: {log_path})")
+
+        return Result(host, report_path, detected)
 
     except Exception as e:
         print(f"[ERROR] {host}: {e}", file=sys.stderr)
-        return {
-            "host": host,
-            "report_path": None,
-            "log_path": None if QUIET else log_path,
-            "detected": False,
-        }
-    finally:
-        # 空ルールディレクトリを作った場合は削除
-        if temp_rules_dir and os.path.isdir(temp_rules_dir):
-            shutil.rmtree(temp_rules_dir, ignore_errors=True)
+        return Result(host, None, False)
+
+
+# ====== 全ホスト一括実行（BATCH_ALL_HOSTS=true） ======
+_UNKNOWN_HOST = "(unknown host)"  # path からホストを特定できない検出の集約先
+
+
+def _host_for_path(path: str, host_prefixes: list[tuple[str, str]]) -> str | None:
+    for prefix, host in host_prefixes:
+        if path.startswith(prefix):
+            return host
+    return None
+
+
+def _attribute_detections(out_dir: str, host_prefixes: list[tuple[str, str]]) -> dict[str, str | None]:
+    """
+    一括実行の出力を path 列（JSON は document.path）でホストに振り分け、
+    {ホスト名: レポートパス} を返す。path から特定できない検出は _UNKNOWN_HOST に寄せる。
+    """
+    found = {}
+
+    def mark(path, report_path):
+        host = _host_for_path(path, host_prefixes) if path else None
+        found.setdefault(host or _UNKNOWN_HOST, report_path)
+
+    ext = f".{CHAINS_FORMAT}"
+    with os.scandir(out_dir) as it:
+        for entry in it:
+            if not (entry.name.endswith(ext) and entry.is_file()):
+                continue
+            try:
+                if ext == ".csv":
+                    with open(entry.path, "r", encoding="utf-8", errors="ignore", newline="") as fh:
+                        path_idx = None
+                        for row in csv.reader(fh):
+                            if not any(col.strip() for col in row):
+                                continue
+                            if path_idx is None:
+                                # 先頭の非空行はヘッダー
+                                cols = [col.strip().lower() for col in row]
+                                path_idx = cols.index("path") if "path" in cols else -1
+                                if path_idx == -1:
+                                    print(f"[WARN] path 列が無いため検出をホストに振り分けられません: {entry.path}", file=sys.stderr)
+                                continue
+                            mark(row[path_idx] if 0 <= path_idx < len(row) else None, entry.path)
+                else:
+                    with open(entry.path, "r", encoding="utf-8", errors="ignore") as fh:
+                        data = json.load(fh)
+                    for det in data if isinstance(data, list) else [data]:
+                        if not isinstance(det, dict):
+                            continue
+                        docs = det.get("documents") or [det.get("document")]
+                        for doc in docs:
+                            mark(doc.get("path") if isinstance(doc, dict) else None, entry.path)
+            except Exception as e:
+                print(f"[WARN] レポートの解析に失敗しました: {entry.path}: {e}", file=sys.stderr)
+    return found
+
+
+def run_all_hosts(host_dirs: list[str], rules_dir: str, sigma_dir: str) -> list[tuple[str, str | None]]:
+    """
+    全ホストを 1 回の chainsaw hunt で処理し、検出のあった (ホスト名, レポートパス) を返す。
+    PATH には対象ファイルのあるホストディレクトリを渡す（ファイルを列挙して渡すと ARG_MAX を超えうるため）。
+    """
+    host_prefixes = []
+    target_dirs = []
+    for hd in host_dirs:
+        host = os.path.basename(hd.rstrip("/"))
+        host_prefixes.append((hd.rstrip("/") + os.sep, host))
+        if _has_targets(hd):
+            target_dirs.append(hd)
+
+    if not target_dirs:
+        print(f"[CLEAN] (all hosts) -> no target files found under {EVTX_ROOT}")
+        return []
+
+    ts = datetime.now().strftime("%Y%m%d%H%M%S")
+    out_dir = os.path.join(REPORTS_DIR, f"scan-{ts}")
+    os.makedirs(out_dir, exist_ok=True)
+    log_path = os.path.join(out_dir, f"scan-{ts}.log")
+
+    try:
+        cmd = build_hunt_cmd(target_dirs, output_dir=out_dir, rules_dir=rules_dir, sigma_dir=sigma_dir, force_non_quiet=not QUIET)
+        if QUIET:
+            returncode = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False).returncode
+        else:
+            with open(log_path, "wb", buffering=0) as lf:
+                header = [
+                    f"# started: {datetime.now().isoformat()}\n",
+                    f"# hosts: {len(target_dirs)}/{len(host_dirs)}\n",
+                    f"# levels: {','.join(CHAINS_LEVELS) if CHAINS_LEVELS else 'ALL'}\n",
+                    f"# mode: {CHAINS_MODE}, format: {CHAINS_FORMAT}\n",
+                    f"# output_dir: {out_dir}\n",
+                    f"# rules_dir: {rules_dir}\n",
+                    f"# sigma_dir: {sigma_dir}\n\n",
+                    f"# cmd: {' '.join(cmd)}\n",
+                ]
+                lf.write("".join(header).encode("utf-8"))
+                returncode = subprocess.run(cmd, stdout=lf, stderr=lf, check=False).returncode
+
+        if returncode != 0:
+            # 異常終了時はレポートが不完全なので「全ホスト検出なし」とは扱わない
+            log_note = "" if QUIET else f", log: {log_path}"
+            print(f"[ERROR] (all hosts): chainsaw が異常終了しました (exit {returncode}{log_note})", file=sys.stderr)
+            return []
+
+        found = _attribute_detections(out_dir, host_prefixes)
+    except Exception as e:
+        print(f"[ERROR] (all hosts): {e}", file=sys.stderr)
+        return []
+
+    for _, host in host_prefixes:
+        if host in found:
+            print(f"[DETECTED] {host} -> {found[host] or '(no report file)'}")
+        else:
+            print(f"[CLEAN] {host} -> (no report file)")
+    if _UNKNOWN_HOST in found:
+        print(f"[DETECTED] {_UNKNOWN_HOST} -> {found[_UNKNOWN_HOST]}")
+    return list(found.items())
 
 
 # ====== メール送信 ======
+_SSL_CTX = ssl.create_default_context()
+
+
 def send_mail(subject: str, body: str):
     if not (SMTP_HOST and MAIL_FROM and MAIL_TO):
         print("[WARN] SMTP/MAIL の設定が不十分のためメールは送信されません。", file=sys.stderr)
@@ -284,42 +453,86 @@ def send_mail(subject: str, body: str):
     msg["From"]    = MAIL_FROM
     msg["To"]      = ", ".join(MAIL_TO)
 
-    if SMTP_TLS:
-        context = ssl.create_default_context()
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-            server.ehlo()
-            server.starttls(context=context)
-            server.ehlo()
-            if SMTP_USER and SMTP_PASS:
-                server.login(SMTP_USER, SMTP_PASS)
-            server.sendmail(MAIL_FROM, MAIL_TO, msg.as_string())
-    else:
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-            if SMTP_USER and SMTP_PASS:
-                server.login(SMTP_USER, SMTP_PASS)
-            server.sendmail(MAIL_FROM, MAIL_TO, msg.as_string())
+    with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
+        if SMTP_TLS:
+            server.starttls(context=_SSL_CTX)  # EHLO は starttls/login/送信時に必要に応じて自動で送られる
+        if SMTP_USER and SMTP_PASS:
+            server.login(SMTP_USER, SMTP_PASS)
+        server.send_message(msg, from_addr=MAIL_FROM, to_addrs=MAIL_TO)
+
+
+# ====== Sigma ルールの tmpfs 配置（SIGMA_SHM=true） ======
+def _stage_sigma_shm() -> str:
+    """
+    SIGMA_DIR を /dev/shm/sigma-XXXX/ にコピーしてそのパスを返す（終了時に削除）。
+    /dev/shm が無い・コピーに失敗した場合は SIGMA_DIR をそのまま返す。
+    """
+    if not os.path.isdir("/dev/shm"):
+        print("[WARN] /dev/shm が無いため SIGMA_SHM は無視されます。", file=sys.stderr)
+        return SIGMA_DIR
+    try:
+        # 自プロセスが作成した一意なディレクトリのみを削除対象にする
+        dst = tempfile.mkdtemp(dir="/dev/shm", prefix="sigma-")
+    except OSError as e:
+        print(f"[WARN] /dev/shm に作業ディレクトリを作成できません: {e}", file=sys.stderr)
+        return SIGMA_DIR
+    atexit.register(shutil.rmtree, dst, ignore_errors=True)
+    try:
+        shutil.copytree(SIGMA_DIR, dst, dirs_exist_ok=True, ignore=shutil.ignore_patterns(".git"))  # clone 履歴は不要
+    except Exception as e:
+        # 途中までのコピーが tmpfs（RAM）を占有し続けないよう即座に削除
+        shutil.rmtree(dst, ignore_errors=True)
+        print(f"[WARN] Sigma ルールの /dev/shm へのコピーに失敗しました: {e}", file=sys.stderr)
+        return SIGMA_DIR
+    return dst
 
 
 # ====== メイン ======
 def main():
-    # evtx/<HOST> のみ対象
-    host_dirs = [os.path.join(EVTX_ROOT, d) for d in os.listdir(EVTX_ROOT)
-                 if os.path.isdir(os.path.join(EVTX_ROOT, d))]
+    # evtx/<HOST> のみ対象（d_type を使うので通常はエントリごとの stat が不要）
+    with os.scandir(EVTX_ROOT) as it:
+        host_dirs = [entry.path for entry in it if entry.is_dir()]
     if not host_dirs:
         die(f"ホストディレクトリが見つかりません: {EVTX_ROOT}/*")
 
-    results = []
-    # 並列数は適宜調整（I/O中心ならやや多めでもOK）
-    with ThreadPoolExecutor(max_workers=4) as ex:
-        futures = {ex.submit(run_for_host, hd): hd for hd in host_dirs}
-        for fut in as_completed(futures):
-            res = fut.result()
-            results.append(res)
-            status = "DETECTED" if res["detected"] else "CLEAN"
-            print(f"[{status}] {res['host']} -> {res.get('report_path')}")
+    # 並列数：chainsaw は CPU バウンドなのでコア数まで（SCAN_WORKERS で上書き可）
+    # subprocess 待ちの間は GIL を解放するためスレッドで十分
+    if SCAN_WORKERS:
+        try:
+            workers = max(1, int(SCAN_WORKERS))
+        except ValueError:
+            die(f"SCAN_WORKERS は整数で指定してください: {SCAN_WORKERS}")
+    else:
+        workers = max(1, os.cpu_count() or 4)
+    workers = min(len(host_dirs), workers)
+
+    # RULES_DIR（Chainsaw独自ルール）必須対応：設定が無ければ空ディレクトリを全ホストで共用
+    rules_dir = CHAINS_RULE_DIR
+    if not rules_dir:
+        rules_dir = tempfile.mkdtemp(prefix="chainsaw_rules_")  # 空でOK（SigmaのみでもCLI要件を満たすため）
+        atexit.register(shutil.rmtree, rules_dir, ignore_errors=True)
+
+    # SIGMA_SHM=true なら Sigma ルールを tmpfs に一度だけコピーし、以降はそこを参照
+    sigma_dir = _stage_sigma_shm() if SIGMA_SHM else SIGMA_DIR
+
+    batch = BATCH_ALL_HOSTS
+    if batch and CHAINS_FORMAT not in ("csv", "json"):
+        print(f"[WARN] BATCH_ALL_HOSTS は CHAINS_FORMAT={CHAINS_FORMAT} に未対応のためホスト単位で実行します。", file=sys.stderr)
+        batch = False
+
+    # 検出のあったホストのみ (host, report_path) を保持（状況表示はワーカー側で出力済み）
+    detected_hosts = []
+    if batch:
+        detected_hosts = run_all_hosts(host_dirs, rules_dir, sigma_dir)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = {ex.submit(run_for_host, hd, rules_dir, sigma_dir): hd for hd in host_dirs}
+            for fut in as_completed(futures):
+                res = fut.result()
+                if res.detected:
+                    detected_hosts.append((res.host, res.report_path))
 
     # 検出のあったホストの要約と通知
-    detected_hosts = [r for r in results if r["detected"]]
     if detected_hosts:
         lines = []
         lines.append("Chainsaw 検出結果サマリ")
@@ -329,11 +542,18 @@ def main():
         if FROM or TO:
             lines.append(f"期間: {FROM or '-'} ～ {TO or '-'}")
         lines.append("")
-        for r in detected_hosts:
-            lines.append(f"- {r['host']}: {r['report_path'] or '(report not found)'}")
+        for host, report_path in detected_hosts:
+            lines.append(f"- {host}: {report_path or '(report not found)'}")
         body = "\n".join(lines)
 
-        subject = f"{MAIL_SUBJECT_PREFIX} {len(detected_hosts)} host(s) detected"
+        # ホストを特定できない検出は件数とは別に件名で明示する（件名が "0 host(s)" にならないように）
+        host_count = sum(1 for host, _ in detected_hosts if host != _UNKNOWN_HOST)
+        parts = []
+        if host_count:
+            parts.append(f"{host_count} host(s) detected")
+        if host_count < len(detected_hosts):
+            parts.append("unattributed detections")
+        subject = f"{MAIL_SUBJECT_PREFIX} {', '.join(parts)}"
         send_mail(subject, body)
     else:
         print("[INFO] 検出はありませんでした。メールは送信されません。")